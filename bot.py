@@ -2,277 +2,605 @@ import os
 import re
 import logging
 import asyncio
-from datetime import datetime
+import time
+import weakref
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from pathlib import Path
+from dataclasses import dataclass
+from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 
 import aiosqlite
+import orjson
+from cachetools import LRUCache, TTLCache
 from aiohttp import web
-from aiogram import Bot, Dispatcher, F
-from aiogram.filters import Command
+from aiogram import Bot, Dispatcher, F, Router
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.filters import Command, CommandObject, StateFilter
+from aiogram.filters.callback_data import CallbackData
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.memory import MemoryStorage, MemoryStorageRecord, SimpleEventIsolation
 from aiogram.types import Message, CallbackQuery, LabeledPrice, PreCheckoutQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from dotenv import load_dotenv
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 
-BOT_TOKEN = os.getenv("BOT_TOKEN", "")
-ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
-PORT = int(os.getenv("PORT", "10000"))
-TZ = ZoneInfo("Europe/Helsinki")
-EUR_TO_STARS = int(os.getenv("EUR_TO_STARS", "50") or "50")
-
-PAYPAL_LINK = os.getenv("PAYPAL_LINK", "")
-SEPA_RECIPIENT = os.getenv("SEPA_RECIPIENT", "")
-SEPA_IBAN = os.getenv("SEPA_IBAN", "")
-SEPA_BIC = os.getenv("SEPA_BIC", "")
+@dataclass(frozen=True, slots=True)
+class Config:
+    bot_token: str
+    admin_id: int
+    port: int
+    db_path: str
+    redis_url: str
+    tz: ZoneInfo
+    eur_to_stars: int
+
+    paypal_link: str
+    sepa_recipient: str
+    sepa_iban: str
+    sepa_bic: str
+
+    zen_name: str
+    zen_phone: str
+    zen_card: str
+    zen_iban: str
+    zen_bic: str
+
+def load_config() -> Config:
+    return Config(
+        bot_token=os.getenv("BOT_TOKEN", ""),
+        admin_id=int(os.getenv("ADMIN_ID", "0")),
+        port=int(os.getenv("PORT", "10000")),
+        db_path=os.getenv("DB_PATH", "data.db"),
+        redis_url=os.getenv("REDIS_URL", ""),
+        tz=ZoneInfo("Europe/Helsinki"),
+        eur_to_stars=int(os.getenv("EUR_TO_STARS", "50") or "50"),
+
+        paypal_link=os.getenv("PAYPAL_LINK", ""),
+        sepa_recipient=os.getenv("SEPA_RECIPIENT", ""),
+        sepa_iban=os.getenv("SEPA_IBAN", ""),
+        sepa_bic=os.getenv("SEPA_BIC", ""),
+
+        zen_name=os.getenv("ZEN_NAME", ""),
+        zen_phone=os.getenv("ZEN_PHONE", ""),
+        zen_card=os.getenv("ZEN_CARD", ""),
+        zen_iban=os.getenv("ZEN_IBAN", ""),
+        zen_bic=os.getenv("ZEN_BIC", ""),
+    )
 
-ZEN_NAME = os.getenv("ZEN_NAME", "")
-ZEN_PHONE = os.getenv("ZEN_PHONE", "")
-ZEN_CARD = os.getenv("ZEN_CARD", "")
-ZEN_IBAN = os.getenv("ZEN_IBAN", "")
-ZEN_BIC = os.getenv("ZEN_BIC", "")
+CFG = load_config()
 
-if not BOT_TOKEN:
+if not CFG.bot_token:
     raise RuntimeError("BOT_TOKEN is missing")
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
-DB_PATH = "data.db"
-
-# user_id -> state
-PENDING: dict[int, dict] = {}
-
-FITR_OPEN_DT = datetime(2026, 3, 9, 0, 0, tzinfo=TZ)
-FITR_PAYPAL_CLOSE_DT = datetime(2026, 3, 17, 23, 59, tzinfo=TZ)
-FITR_ZEN_CLOSE_DT = datetime(2026, 3, 18, 14, 0, tzinfo=TZ)
+class TelegramSession(AiohttpSession):
+    # One pooled connector for every Bot API call; idle TLS connections to
+    # api.telegram.org are kept well past aiohttp's 15 s default.
+    # orjson encodes reply markup and decodes API replies faster than stdlib json.
+    def __init__(self, **kwargs):
+        kwargs.setdefault("json_loads", orjson.loads)
+        kwargs.setdefault("json_dumps", lambda obj: orjson.dumps(obj).decode())
+        super().__init__(**kwargs)
+        self._connector_init.update(
+            limit=200,
+            ttl_dns_cache=300,
+            keepalive_timeout=120,
+            enable_cleanup_closed=True,
+        )
 
-EID_OPEN_DT = datetime(2026, 3, 9, 0, 0, tzinfo=TZ)
-EID_CLOSE_DT = datetime(2026, 3, 18, 0, 0, tzinfo=TZ)
-EID_EXTRA_CLOSE_DT = datetime(2026, 3, 19, 0, 0, tzinfo=TZ)
+class FSMRecords(TTLCache):
+    # TTLCache times entries from insertion; re-inserting on every access makes the TTL
+    # count from the user's last update instead.
+    def __getitem__(self, key):
+        record = super().__getitem__(key)
+        self[key] = record
+        return record
+
+    def __missing__(self, key):
+        record = self[key] = MemoryStorageRecord()
+        return record
+
+class BoundedEventIsolation(SimpleEventIsolation):
+    # SimpleEventIsolation never drops a user's lock; here a lock lives only while a
+    # handler holds it or waits on it.
+    def __init__(self):
+        super().__init__()
+        self._locks = weakref.WeakValueDictionary()
+
+    @asynccontextmanager
+    async def lock(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        async with lock:
+            yield
+
+class BoundedMemoryStorage(MemoryStorage):
+    # MemoryStorage keeps a record for every user ever seen; this one forgets users idle for a day.
+    def __init__(self):
+        super().__init__()
+        self.storage = FSMRecords(maxsize=50_000, ttl=86400)
+
+    def create_isolation(self):
+        return BoundedEventIsolation()
+
+def fsm_storage():
+    # With REDIS_URL set, flow state survives restarts; otherwise it stays in this process.
+    if not CFG.redis_url:
+        return BoundedMemoryStorage()
+    from aiogram.fsm.storage.redis import RedisStorage
+    return RedisStorage.from_url(CFG.redis_url, state_ttl=86400, data_ttl=86400)
+
+bot = Bot(token=CFG.bot_token, session=TelegramSession())
+FSM_STORAGE = fsm_storage()
+# Updates from the same user run one at a time, so a double tap can't interleave two
+# handlers on that user's FSM state.
+dp = Dispatcher(storage=FSM_STORAGE, events_isolation=FSM_STORAGE.create_isolation())
+# Admin commands; updates from anyone else are dropped at the router filter.
+admin_router = Router()
+admin_router.message.filter(F.from_user.id == CFG.admin_id)
+dp.include_router(admin_router)
+# Opened once in db_init(); writes serialise on DB_LOCK so commits don't interleave.
+DB: aiosqlite.Connection | None = None
+DB_LOCK = asyncio.Lock()
+# Write-through copy of the whole kv table (a few dozen rows), loaded in db_init().
+KV_CACHE: dict[str, str] = {}
+# Parsed ints for the numeric kv keys; entries are dropped whenever the key is written.
+KV_INT: dict[str, int] = {}
+# user_id -> lang (None = not chosen yet); set_user_lang writes through.
+LANG_CACHE: LRUCache[int, str | None] = LRUCache(maxsize=10_000)
+# (campaign, lang) -> rendered screen text; dropped on every kv/fitr write.
+SCREEN_CACHE: dict[tuple[str, str], str] = {}
+SCREEN_VERSION = 0
+
+ADMIN_QUEUE: asyncio.Queue[str] = asyncio.Queue(maxsize=1000)
+# telegram_payment_charge_id of recently handled Stars payments; Telegram may redeliver the update.
+SEEN_PAYMENTS: LRUCache[str, bool] = LRUCache(maxsize=10_000)
+
+# Telegram allows roughly one editMessageText per second per chat.
+EDIT_RATE = 1.0
+EDIT_BURST = 2.0
+# chat_id -> (tokens, monotonic ts of last refill)
+EDIT_BUCKETS: TTLCache[int, tuple[float, float]] = TTLCache(maxsize=50_000, ttl=3600)
+# chat_id -> monotonic ts until which Telegram asked us to back off
+EDIT_PENALTY: TTLCache[int, float] = TTLCache(maxsize=50_000, ttl=3600)
+# chat_id -> (message_id, text, reply_markup) of the last successful edit
+LAST_EDIT: TTLCache[int, tuple] = TTLCache(maxsize=50_000, ttl=3600)
+# chat_id -> (message, text, reply_markup, parse_mode) of the newest edit not yet sent
+PENDING_EDITS: dict[int, tuple] = {}
+
+FITR_OPEN_DT = datetime(2026, 3, 9, 0, 0, tzinfo=CFG.tz)
+FITR_PAYPAL_CLOSE_DT = datetime(2026, 3, 17, 23, 59, tzinfo=CFG.tz)
+FITR_ZEN_CLOSE_DT = datetime(2026, 3, 18, 14, 0, tzinfo=CFG.tz)
+
+EID_OPEN_DT = datetime(2026, 3, 9, 0, 0, tzinfo=CFG.tz)
+EID_CLOSE_DT = datetime(2026, 3, 18, 0, 0, tzinfo=CFG.tz)
+EID_EXTRA_CLOSE_DT = datetime(2026, 3, 19, 0, 0, tzinfo=CFG.tz)
 
 
 # =========================
 # Helpers
 # =========================
 
+# Shown before the user has picked a language, so it is not localised.
+WELCOME_TEXT = "Мир вам! Выберите язык дальнейшего общения"
+THANKS_TEXT = "🌸 Джазак Аллаху хейр! Пусть ваши благие дела станут ключом к вратам Рая 🤍"
+# (ru, en) pairs for t(), shared by several handlers
+CHOOSE_CAMPAIGN_TEXT = ("Выберите сбор:", "Choose campaign:")
+ENTER_NUMBER_TEXT = ("Введите только число. Пример: 5", "Enter only a number. Example: 5")
+
+STRINGS: dict[str, dict[str, str]] = {
+    "ru": {
+        "people_n": "{n} человек",
+        "fitr_due": "Вам необходимо раздать: *{kg} кг*\nСумма к оплате: *{eur}€*\nКод оплаты: `{code}`",
+        "fitr_pay": "Сумма к оплате: *{eur}€*\nКод оплаты: `{code}`",
+    },
+    "en": {
+        "people_n": "{n} people",
+        "fitr_due": "You need to distribute: *{kg} kg*\nAmount to pay: *{eur}€*\nPayment code: `{code}`",
+        "fitr_pay": "Amount to pay: *{eur}€*\nPayment code: `{code}`",
+    },
+}
+
 def t(lang: str, ru: str, en: str) -> str:
     return ru if lang == "ru" else en
 
+def tr(lang: str, key: str, **kw) -> str:
+    return STRINGS["ru" if lang == "ru" else "en"][key].format_map(kw)
+
 def now_hki() -> datetime:
-    return datetime.now(TZ)
+    return datetime.now(CFG.tz)
+
+# (minute since epoch, its formatted stamp); stamps only have minute resolution.
+UTC_STAMP: tuple[int, str] = (-1, "")
+
+def utc_now_str() -> str:
+    global UTC_STAMP
+    minute = int(time.time()) // 60
+    if UTC_STAMP[0] != minute:
+        UTC_STAMP = (minute, datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M UTC"))
+    return UTC_STAMP[1]
 
 def admin_only(user_id: int) -> bool:
-    return bool(ADMIN_ID) and user_id == ADMIN_ID
+    return bool(CFG.admin_id) and user_id == CFG.admin_id
+
+DIGITS_RE = re.compile(r"\d+")
 
 def extract_positive_int(text: str) -> int | None:
     if not text:
         return None
-    m = re.search(r"\d+", text)
-    if not m:
+    if text.isdecimal():
+        digits = text
+    else:
+        m = DIGITS_RE.search(text)
+        if not m:
+            return None
+        digits = m.group()
+    if len(digits) > 9:
         return None
-    n = int(m.group())
+    n = int(digits)
     return n if n > 0 else None
 
+INT_ARG_RE = re.compile(r"\s+(\d{1,9})\s*$")
+
+def parse_int_arg(text: str) -> int | None:
+    # trailing integer argument of an admin command, e.g. "/fitr price 12" -> 12
+    m = INT_ARG_RE.search(text or "")
+    return int(m.group(1)) if m else None
+
+FITR_CODE_RE = re.compile(r"ZF(\d+)")
+
+def fitr_subcommand_args(text: str) -> str:
+    # "/fitr <subcommand> <args...>" -> "<args...>"
+    parts = text.split(None, 2)
+    return parts[2].strip() if len(parts) == 3 else ""
+
 def parse_fitr_code(code: str) -> int | None:
     code = (code or "").strip().upper()
-    m = re.fullmatch(r"ZF(\d+)", code)
+    m = FITR_CODE_RE.fullmatch(code)
     if not m:
         return None
     n = int(m.group(1))
     return n if n > 0 else None
 
-def battery(current: int, total: int, width: int = 10) -> str:
+# Every progress bar the bot can draw, indexed by the number of filled cells.
+BARS = ["▰" * i + "▱" * (10 - i) for i in range(11)]
+
+def battery(current: int, total: int) -> str:
     if total <= 0:
-        return "▱" * width
+        return BARS[0]
     ratio = max(0.0, min(1.0, current / total))
-    filled = int(round(ratio * width))
-    return "▰" * filled + "▱" * (width - filled)
+    return BARS[int(round(ratio * 10))]
+
+def edit_delay(chat_id: int) -> float:
+    # Token bucket per chat: EDIT_RATE edits/sec with bursts of EDIT_BURST.
+    now = time.monotonic()
+    tokens, last = EDIT_BUCKETS.get(chat_id, (EDIT_BURST, now))
+    tokens = min(EDIT_BURST, tokens + (now - last) * EDIT_RATE) - 1
+    EDIT_BUCKETS[chat_id] = (tokens, now)
+    return 0.0 if tokens >= 0 else -tokens / EDIT_RATE
 
 async def safe_edit(call: CallbackQuery, text: str, reply_markup=None, parse_mode=None):
+    # Edits go out from a per-chat background flusher, so waiting on the rate limit never
+    # holds up the handler; taps made meanwhile collapse into the newest one.
+    chat_id = call.message.chat.id
+    flushing = chat_id in PENDING_EDITS
+    PENDING_EDITS[chat_id] = (call.message, text, reply_markup, parse_mode)
+    if not flushing:
+        background(flush_edits(chat_id))
+
+async def flush_edits(chat_id: int):
+    retried = False
     try:
-        await call.message.edit_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
-    except TelegramBadRequest:
-        await call.message.answer(text, reply_markup=reply_markup, parse_mode=parse_mode)
+        while True:
+            wait = max(EDIT_PENALTY.get(chat_id, 0.0) - time.monotonic(), edit_delay(chat_id))
+            if wait > 0:
+                await asyncio.sleep(wait)
+            edit = PENDING_EDITS[chat_id]
+            msg, text, reply_markup, parse_mode = edit
+            if LAST_EDIT.get(chat_id) != (msg.message_id, text, reply_markup):
+                try:
+                    await msg.edit_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+                    LAST_EDIT[chat_id] = (msg.message_id, text, reply_markup)
+                except TelegramRetryAfter as e:
+                    EDIT_PENALTY[chat_id] = time.monotonic() + e.retry_after
+                    if not retried:
+                        # Try again once after the back-off, with whatever edit is newest by then.
+                        retried = True
+                        continue
+                    await asyncio.sleep(e.retry_after)
+                    await msg.answer(text, reply_markup=reply_markup, parse_mode=parse_mode)
+                except TelegramBadRequest as e:
+                    if "message is not modified" not in str(e):
+                        await msg.answer(text, reply_markup=reply_markup, parse_mode=parse_mode)
+            retried = False
+            if PENDING_EDITS[chat_id] is edit:
+                break
+    finally:
+        PENDING_EDITS.pop(chat_id, None)
+
+# Strong refs to fire-and-forget tasks; the event loop only keeps weak ones.
+BACKGROUND: set[asyncio.Task] = set()
+
+def _background_done(task: asyncio.Task):
+    BACKGROUND.discard(task)
+    if not task.cancelled() and task.exception():
+        logging.error("background call failed", exc_info=task.exception())
+
+def background(aw):
+    task = asyncio.ensure_future(aw)
+    BACKGROUND.add(task)
+    task.add_done_callback(_background_done)
+
+def ack(call: CallbackQuery):
+    # Stops the button spinner without holding up the handler on that round trip.
+    background(call.answer())
+
+async def send_admin(text: str):
+    for _ in range(3):
+        try:
+            await bot.send_message(CFG.admin_id, text)
+            return
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except Exception:
+            logging.exception("notify_admin failed")
+            return
+    logging.error("notify_admin gave up after retries")
 
 async def notify_admin(text: str):
-    if not ADMIN_ID:
+    # Queued so donor replies never wait on the admin chat; sent inline only when the queue is full.
+    if not CFG.admin_id:
         return
     try:
-        await bot.send_message(ADMIN_ID, text)
-    except Exception:
-        logging.exception("notify_admin failed")
+        ADMIN_QUEUE.put_nowait(text)
+    except asyncio.QueueFull:
+        await send_admin(text)
+
+async def admin_notify_worker():
+    # Whatever queued up while the previous send was in flight goes out as one message,
+    # kept under Telegram's 4096-character limit.
+    carry = None
+    while True:
+        batch = [carry if carry is not None else await ADMIN_QUEUE.get()]
+        carry = None
+        size = len(batch[0])
+        while not ADMIN_QUEUE.empty():
+            text = ADMIN_QUEUE.get_nowait()
+            if size + 2 + len(text) > 4096:
+                carry = text
+                break
+            batch.append(text)
+            size += 2 + len(text)
+        try:
+            await send_admin("\n\n".join(batch))
+        finally:
+            for _ in batch:
+                ADMIN_QUEUE.task_done()
 
 
 # =========================
 # DB
 # =========================
 
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS kv (
+    k TEXT PRIMARY KEY,
+    v TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_prefs (
+    user_id INTEGER PRIMARY KEY,
+    lang TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fitr_people (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    username TEXT NOT NULL,
+    method TEXT NOT NULL,
+    display_name TEXT NOT NULL,
+    country TEXT NOT NULL,
+    city TEXT NOT NULL,
+    people_count INTEGER NOT NULL,
+    amount_eur INTEGER NOT NULL,
+    rice_kg INTEGER NOT NULL,
+    code TEXT NOT NULL,
+    comment TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_fitr_people_code ON fitr_people(code);
+CREATE TABLE IF NOT EXISTS text_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    k TEXT NOT NULL,
+    old_v TEXT NOT NULL,
+    new_v TEXT NOT NULL,
+    ts TEXT NOT NULL
+);
+"""
+
+KV_DEFAULTS = {
+    "water_target_eur": "235",
+    "water_raised_eur": "0",
+    "water_open_mode": "on",
+
+    "iftar_day": "27",
+    "iftar_target_portions": "800",
+    "iftar_raised_portions": "0",
+    "iftar_open_mode": "on",
+
+    "fitr_saa_eur": "10",
+    "fitr_open_mode": "auto",
+    "fitr_reported_10kg": "0",
+
+    "eid_open_mode": "auto",
+    "eid_raised_eur": "0",
+    "eid_target_eur": "0",
+    "eid_extra_day": "off",
+
+    "desc_water_ru": "Раздача 5000 л питьевой воды.",
+    "desc_water_en": "Distribution of 5000 L of drinking water.",
+
+    "desc_iftar_ru": "Сбор на ифтары текущего дня Рамадана.",
+    "desc_iftar_en": "Collection for the current Ramadan iftar day.",
+
+    "desc_fitr_ru": (
+        "Мы распределяем Закят-уль-Фитр в Газе и иногда для опоздавших в палестинских лагерях Иордании.\n\n"
+        "Сумма закят-уль-фитр: 10€ / 1 человек.\n"
+        "Это цена 1 са'а = 3 кг риса.\n\n"
+        "При переводе используйте код сбора: ZF и количество человек.\n"
+        "Пример: ZF5"
+    ),
+    "desc_fitr_en": (
+        "We distribute Zakat al-Fitr in Gaza and sometimes for late payers in Palestinian camps in Jordan.\n\n"
+        "Amount of zakat-ul-fitr: 10€ / 1 person.\n"
+        "Equal to price of 1 sa'a = 3 kg of rice.\n\n"
+        "Use code ZF with the number of persons.\n"
+        "Example: ZF5"
+    ),
+
+    "desc_eid_ru": "Сбор на сладкую традиционную выпечку «кяки» или что-то подобное, в честь праздника.",
+    "desc_eid_en": "Collection for traditional sweet pastry “kyaky” or something similar for the holiday.",
+}
+
+@asynccontextmanager
+async def db_write():
+    # One locked transaction: committed on success, rolled back on any error so a
+    # half-done write can't ride along with the next writer's commit.
+    async with DB_LOCK:
+        try:
+            yield
+            await DB.commit()
+        except BaseException:
+            await DB.rollback()
+            raise
+
 async def db_init():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS kv (
-            k TEXT PRIMARY KEY,
-            v TEXT NOT NULL
-        )
-        """)
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS user_prefs (
-            user_id INTEGER PRIMARY KEY,
-            lang TEXT NOT NULL
-        )
-        """)
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS fitr_people (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            ts TEXT NOT NULL,
-            user_id INTEGER NOT NULL,
-            username TEXT NOT NULL,
-            method TEXT NOT NULL,
-            display_name TEXT NOT NULL,
-            country TEXT NOT NULL,
-            city TEXT NOT NULL,
-            people_count INTEGER NOT NULL,
-            amount_eur INTEGER NOT NULL,
-            rice_kg INTEGER NOT NULL,
-            code TEXT NOT NULL,
-            comment TEXT NOT NULL
-        )
-        """)
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS text_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            k TEXT NOT NULL,
-            old_v TEXT NOT NULL,
-            new_v TEXT NOT NULL,
-            ts TEXT NOT NULL
-        )
-        """)
-
-        defaults = {
-            "water_target_eur": "235",
-            "water_raised_eur": "0",
-            "water_open_mode": "on",
-
-            "iftar_day": "27",
-            "iftar_target_portions": "800",
-            "iftar_raised_portions": "0",
-            "iftar_open_mode": "on",
-
-            "fitr_saa_eur": "10",
-            "fitr_open_mode": "auto",
-            "fitr_reported_10kg": "0",
-
-            "eid_open_mode": "auto",
-            "eid_raised_eur": "0",
-            "eid_target_eur": "0",
-            "eid_extra_day": "off",
-
-            "desc_water_ru": "Раздача 5000 л питьевой воды.",
-            "desc_water_en": "Distribution of 5000 L of drinking water.",
-
-            "desc_iftar_ru": "Сбор на ифтары текущего дня Рамадана.",
-            "desc_iftar_en": "Collection for the current Ramadan iftar day.",
-
-            "desc_fitr_ru": (
-                "Мы распределяем Закят-уль-Фитр в Газе и иногда для опоздавших в палестинских лагерях Иордании.\n\n"
-                "Сумма закят-уль-фитр: 10€ / 1 человек.\n"
-                "Это цена 1 са'а = 3 кг риса.\n\n"
-                "При переводе используйте код сбора: ZF и количество человек.\n"
-                "Пример: ZF5"
-            ),
-            "desc_fitr_en": (
-                "We distribute Zakat al-Fitr in Gaza and sometimes for late payers in Palestinian camps in Jordan.\n\n"
-                "Amount of zakat-ul-fitr: 10€ / 1 person.\n"
-                "Equal to price of 1 sa'a = 3 kg of rice.\n\n"
-                "Use code ZF with the number of persons.\n"
-                "Example: ZF5"
-            ),
-
-            "desc_eid_ru": "Сбор на сладкую традиционную выпечку «кяки» или что-то подобное, в честь праздника.",
-            "desc_eid_en": "Collection for traditional sweet pastry “kyaky” or something similar for the holiday."
-        }
-
-        for k, v in defaults.items():
-            await db.execute("INSERT OR IGNORE INTO kv(k,v) VALUES(?,?)", (k, v))
-
-        await db.commit()
+    global DB
+    Path(CFG.db_path).parent.mkdir(parents=True, exist_ok=True)
+    DB = await aiosqlite.connect(CFG.db_path)
+    await DB.execute("PRAGMA journal_mode=WAL")
+    await DB.execute("PRAGMA synchronous=NORMAL")
+    await DB.execute("PRAGMA temp_store=MEMORY")
+    await DB.execute("PRAGMA cache_size=-8000")
+    async with db_write():
+        await DB.executescript(SCHEMA_SQL)
+        await DB.executemany("INSERT OR IGNORE INTO kv(k,v) VALUES(?,?)", KV_DEFAULTS.items())
+
+    async with DB.execute("SELECT k,v FROM kv") as cur:
+        KV_CACHE.update(await cur.fetchall())
+
+def invalidate_screens():
+    global SCREEN_VERSION
+    SCREEN_VERSION += 1
+    SCREEN_CACHE.clear()
 
 async def kv_get(key: str) -> str:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT v FROM kv WHERE k=?", (key,)) as cur:
-            row = await cur.fetchone()
-            return row[0] if row else ""
+    return KV_CACHE.get(key, "")
+
+async def kv_get_int(key: str, default: int) -> int:
+    n = KV_INT.get(key)
+    if n is None:
+        try:
+            n = int(KV_CACHE.get(key, ""))
+        except ValueError:
+            n = default
+        KV_INT[key] = n
+    return n
 
 async def kv_set(key: str, value: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
+    async with db_write():
+        await DB.execute(
             "INSERT INTO kv(k,v) VALUES(?,?) ON CONFLICT(k) DO UPDATE SET v=excluded.v",
             (key, value),
         )
-        await db.commit()
+    KV_CACHE[key] = value
+    KV_INT.pop(key, None)
+    invalidate_screens()
+
+async def kv_raise_int(key: str, value: int) -> bool:
+    # Compare-and-set in one UPDATE: stores value only if it exceeds the current one.
+    async with db_write():
+        cur = await DB.execute(
+            "UPDATE kv SET v=? WHERE k=? AND CAST(v AS INTEGER) < ?",
+            (str(value), key, value),
+        )
+    if not cur.rowcount:
+        return False
+    KV_CACHE[key] = str(value)
+    KV_INT[key] = value
+    return True
 
 async def set_user_lang(user_id: int, lang: str):
     lang = "ru" if lang == "ru" else "en"
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
+    async with db_write():
+        await DB.execute(
             "INSERT INTO user_prefs(user_id, lang) VALUES(?,?) "
             "ON CONFLICT(user_id) DO UPDATE SET lang=excluded.lang",
             (user_id, lang),
         )
-        await db.commit()
+    LANG_CACHE[user_id] = lang
 
 async def get_user_lang(user_id: int) -> str | None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT lang FROM user_prefs WHERE user_id=?", (user_id,)) as cur:
-            row = await cur.fetchone()
-            return row[0] if row else None
-
-async def add_text_history(key: str, old_v: str, new_v: str):
-    ts = datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC")
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
+    if user_id in LANG_CACHE:
+        return LANG_CACHE[user_id]
+    async with DB.execute("SELECT lang FROM user_prefs WHERE user_id=?", (user_id,)) as cur:
+        row = await cur.fetchone()
+    # setdefault: a set_user_lang() that landed during the SELECT wins.
+    return LANG_CACHE.setdefault(user_id, row[0] if row else None)
+
+async def kv_set_text(key: str, value: str):
+    # New value and its undo record commit or roll back together (db_write).
+    ts = utc_now_str()
+    async with db_write():
+        old_v = KV_CACHE.get(key, "")
+        await DB.execute(
+            "INSERT INTO kv(k,v) VALUES(?,?) ON CONFLICT(k) DO UPDATE SET v=excluded.v",
+            (key, value),
+        )
+        await DB.execute(
             "INSERT INTO text_history(k,old_v,new_v,ts) VALUES(?,?,?,?)",
-            (key, old_v, new_v, ts),
+            (key, old_v, value, ts),
         )
-        await db.commit()
+    KV_CACHE[key] = value
+    KV_INT.pop(key, None)
+    invalidate_screens()
 
 async def undo_last_text_change() -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT id,k,old_v FROM text_history ORDER BY id DESC LIMIT 1") as cur:
+    async with db_write():
+        async with DB.execute("SELECT id,k,old_v FROM text_history ORDER BY id DESC LIMIT 1") as cur:
             row = await cur.fetchone()
         if not row:
             return False
         row_id, key, old_v = row
-        await db.execute(
+        await DB.execute(
             "INSERT INTO kv(k,v) VALUES(?,?) ON CONFLICT(k) DO UPDATE SET v=excluded.v",
             (key, old_v),
         )
-        await db.execute("DELETE FROM text_history WHERE id=?", (row_id,))
-        await db.commit()
-        return True
-
-async def fitr_totals() -> tuple[int, int, int]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            "SELECT COALESCE(SUM(amount_eur),0), COALESCE(SUM(people_count),0), COALESCE(SUM(rice_kg),0) FROM fitr_people"
-        ) as cur:
-            row = await cur.fetchone()
-            return int(row[0]), int(row[1]), int(row[2])
-
-async def fitr_count_rows() -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT COUNT(*) FROM fitr_people") as cur:
-            row = await cur.fetchone()
-            return int(row[0])
+        await DB.execute("DELETE FROM text_history WHERE id=?", (row_id,))
+    KV_CACHE[key] = old_v
+    KV_INT.pop(key, None)
+    invalidate_screens()
+    return True
+
+async def fitr_totals() -> tuple[int, int, int, int]:
+    # rows, EUR, people, kg in one scan
+    async with DB.execute(
+        "SELECT COUNT(*), COALESCE(SUM(amount_eur),0), COALESCE(SUM(people_count),0), COALESCE(SUM(rice_kg),0) "
+        "FROM fitr_people"
+    ) as cur:
+        row = await cur.fetchone()
+        return int(row[0]), int(row[1]), int(row[2]), int(row[3])
 
 async def add_fitr_person(user_id: int, username: str, method: str, display_name: str, country: str, city: str,
                           people_count: int, amount_eur: int, code: str, comment: str = "") -> int:
     rice_kg = people_count * 3
-    ts = datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC")
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
+    ts = utc_now_str()
+    async with db_write():
+        cur = await DB.execute(
             """
             INSERT INTO fitr_people(
                 ts,user_id,username,method,display_name,country,city,
@@ -282,27 +610,26 @@ async def add_fitr_person(user_id: int, username: str, method: str, display_name
             (ts, user_id, username or "", method, display_name, country, city,
              people_count, amount_eur, rice_kg, code, comment),
         )
-        await db.commit()
-        return cur.lastrowid
-
-async def get_fitr_rows(limit: int = 200) -> list[tuple]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            """
-            SELECT id,display_name,country,city,amount_eur,code,rice_kg,method,comment
-            FROM fitr_people
-            ORDER BY id ASC
-            LIMIT ?
-            """,
-            (limit,),
-        ) as cur:
-            return await cur.fetchall()
+    invalidate_screens()
+    return cur.lastrowid
+
+async def get_fitr_rows(limit: int = 80) -> list[tuple]:
+    async with DB.execute(
+        """
+        SELECT id,display_name,country,city,amount_eur,code,rice_kg,method,comment
+        FROM fitr_people
+        ORDER BY id ASC
+        LIMIT ?
+        """,
+        (limit,),
+    ) as cur:
+        return await cur.fetchall()
 
 async def update_fitr_row(row_id: int, display_name: str, country: str, city: str,
                           people_count: int, amount_eur: int, method: str, code: str, comment: str):
     rice_kg = people_count * 3
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
+    async with db_write():
+        await DB.execute(
             """
             UPDATE fitr_people
             SET display_name=?, country=?, city=?, people_count=?, amount_eur=?, rice_kg=?, method=?, code=?, comment=?
@@ -310,87 +637,112 @@ async def update_fitr_row(row_id: int, display_name: str, country: str, city: st
             """,
             (display_name, country, city, people_count, amount_eur, rice_kg, method, code, comment, row_id),
         )
-        await db.commit()
+    invalidate_screens()
 
 async def delete_fitr_row(row_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM fitr_people WHERE id=?", (row_id,))
-        await db.commit()
+    async with db_write():
+        await DB.execute("DELETE FROM fitr_people WHERE id=?", (row_id,))
+    invalidate_screens()
 
 async def find_fitr_rows(term: str) -> list[tuple]:
     q = f"%{term}%"
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            """
-            SELECT id,display_name,country,city,amount_eur,code,rice_kg,method
-            FROM fitr_people
-            WHERE display_name LIKE ? OR country LIKE ? OR city LIKE ? OR code LIKE ?
-            ORDER BY id ASC
-            LIMIT 50
-            """,
-            (q, q, q, q),
-        ) as cur:
-            return await cur.fetchall()
+    async with DB.execute(
+        """
+        SELECT id,display_name,country,city,amount_eur,code,rice_kg,method
+        FROM fitr_people
+        WHERE display_name LIKE ? OR country LIKE ? OR city LIKE ? OR code LIKE ?
+        ORDER BY id ASC
+        LIMIT 50
+        """,
+        (q, q, q, q),
+    ) as cur:
+        return await cur.fetchall()
 
 async def possible_fitr_dups() -> list[tuple]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            """
-            SELECT a.id, a.display_name, a.code, b.id, b.display_name, b.code
-            FROM fitr_people a
-            JOIN fitr_people b
-              ON a.id < b.id
-             AND (
-                 (a.display_name = b.display_name AND a.code = b.code)
-                 OR (a.amount_eur = b.amount_eur AND a.code = b.code)
-             )
-            LIMIT 50
-            """
-        ) as cur:
-            return await cur.fetchall()
-
-async def fitr_report_if_needed():
-    total_eur, total_people, total_kg = await fitr_totals()
-    reported = int(await kv_get("fitr_reported_10kg") or "0")
+    async with DB.execute(
+        """
+        SELECT a.id, a.display_name, a.code, b.id, b.display_name, b.code
+        FROM fitr_people a
+        JOIN fitr_people b
+          ON a.id < b.id
+         AND (
+             (a.display_name = b.display_name AND a.code = b.code)
+             OR (a.amount_eur = b.amount_eur AND a.code = b.code)
+         )
+        LIMIT 50
+        """
+    ) as cur:
+        return await cur.fetchall()
+
+async def fitr_report_if_needed() -> tuple[int, int, int, int]:
+    totals = await fitr_totals()
+    _, total_eur, total_people, total_kg = totals
     blocks = total_kg // 10
-    if blocks > reported:
-        await kv_set("fitr_reported_10kg", str(blocks))
+    if blocks > await kv_get_int("fitr_reported_10kg", 0) and await kv_raise_int("fitr_reported_10kg", blocks):
         await notify_admin(
             "📊 FITR REPORT\n"
             f"Total EUR: {total_eur}\n"
             f"People: {total_people}\n"
             f"Rice: {total_kg} kg"
         )
+    return totals
 
 
 # =========================
 # Open/close logic
 # =========================
 
+OPEN_MODES = {"on": True, "off": False}
+
+async def forced_open(key: str) -> bool | None:
+    # "on"/"off" override the schedule; "auto" (or anything else) returns None.
+    return OPEN_MODES.get((await kv_get(key) or "auto").lower())
+
 async def is_fitr_visible() -> bool:
-    mode = (await kv_get("fitr_open_mode") or "auto").lower()
-    if mode == "on":
-        return True
-    if mode == "off":
-        return False
+    forced = await forced_open("fitr_open_mode")
+    if forced is not None:
+        return forced
     return now_hki() >= FITR_OPEN_DT
 
+# fitr method -> (display name, last moment it accepts payments)
+FITR_METHOD_DEADLINES = {
+    "paypal": ("PayPal", FITR_PAYPAL_CLOSE_DT),
+    "zenbank": ("Zen", FITR_ZEN_CLOSE_DT),
+    "zenfast": ("Zen Express", FITR_ZEN_CLOSE_DT),
+}
+
 def fitr_method_open(method: str) -> bool:
-    now = now_hki()
-    if now < FITR_OPEN_DT:
-        return False
-    if method == "paypal":
-        return now <= FITR_PAYPAL_CLOSE_DT
-    if method in {"zenbank", "zenfast"}:
-        return now <= FITR_ZEN_CLOSE_DT
-    return False
+    deadline = FITR_METHOD_DEADLINES.get(method)
+    return deadline is not None and FITR_OPEN_DT <= now_hki() <= deadline[1]
+
+FITR_NOT_OPEN_TEXT = {
+    "ru": f"Приём Закят-уль-Фитр откроется {FITR_OPEN_DT:%d.%m}.",
+    "en": f"Zakat al-Fitr payments open on {FITR_OPEN_DT:%d.%m}.",
+}
+
+# (method, lang) -> closed notice; the deadlines are constants, so these are too.
+FITR_CLOSED_TEXTS = {
+    (method, lang): t(
+        lang,
+        f"Приём фитра через {name} закрыт: срок был до {dt:%d.%m %H:%M} (Хельсинки).",
+        f"Fitr payments via {name} are closed: the deadline was {dt:%d.%m %H:%M} (Helsinki time).",
+    )
+    for method, (name, dt) in FITR_METHOD_DEADLINES.items()
+    for lang in ("ru", "en")
+}
+
+def fitr_close_text(method: str, lang: str) -> str:
+    if now_hki() < FITR_OPEN_DT:
+        return FITR_NOT_OPEN_TEXT[lang]
+    return FITR_CLOSED_TEXTS.get(
+        (method, lang),
+        t(lang, "Этот способ оплаты недоступен.", "This payment method is unavailable."),
+    )
 
 async def is_eid_open() -> bool:
-    mode = (await kv_get("eid_open_mode") or "auto").lower()
-    if mode == "on":
-        return True
-    if mode == "off":
-        return False
+    forced = await forced_open("eid_open_mode")
+    if forced is not None:
+        return forced
     extra = (await kv_get("eid_extra_day") or "off").lower() == "on"
     close_dt = EID_EXTRA_CLOSE_DT if extra else EID_CLOSE_DT
     return EID_OPEN_DT <= now_hki() <= close_dt
@@ -400,107 +752,179 @@ async def is_eid_open() -> bool:
 # Text builders
 # =========================
 
-async def water_text(lang: str) -> str:
-    target = int(await kv_get("water_target_eur") or "235")
-    raised = int(await kv_get("water_raised_eur") or "0")
-    desc = await kv_get(f"desc_water_{lang}")
-    remain = max(0, target - raised)
-    bar = battery(raised, target)
-    if lang == "ru":
-        return (
-            "💧 *Сукья-ль-ма (вода)*\n\n"
-            f"{desc}\n\n"
-            f"Цистерна: *{target}€*\n"
-            f"Собрано: *{raised}€*\n"
-            f"Осталось: *{remain}€*\n"
-            f"{bar}\n\n"
-            "Код оплаты: `Greenmax`"
-        )
-    return (
+WATER_TPL = {
+    "ru": (
+        "💧 *Сукья-ль-ма (вода)*\n\n"
+        "{desc}\n\n"
+        "Цистерна: *{target}€*\n"
+        "Собрано: *{raised}€*\n"
+        "Осталось: *{remain}€*\n"
+        "{bar}\n\n"
+        "Код оплаты: `Greenmax`"
+    ),
+    "en": (
         "💧 *Sukya-l-ma (Water)*\n\n"
-        f"{desc}\n\n"
-        f"Tanker: *{target}€*\n"
-        f"Raised: *{raised}€*\n"
-        f"Remaining: *{remain}€*\n"
-        f"{bar}\n\n"
+        "{desc}\n\n"
+        "Tanker: *{target}€*\n"
+        "Raised: *{raised}€*\n"
+        "Remaining: *{remain}€*\n"
+        "{bar}\n\n"
         "Payment code: `Greenmax`"
-    )
-
-async def iftar_text(lang: str) -> str:
-    day = int(await kv_get("iftar_day") or "27")
-    target = int(await kv_get("iftar_target_portions") or "800")
-    raised = int(await kv_get("iftar_raised_portions") or "0")
-    desc = await kv_get(f"desc_iftar_{lang}")
-    bar = battery(min(raised, target), target)
-    if lang == "ru":
-        return (
-            f"🍲 *Ифтары — {day} Рамадана*\n\n"
-            f"{desc}\n\n"
-            f"Цель: *{target} порций*\n"
-            f"Собрано: *{raised}* / *{target}*\n"
-            f"{bar}\n\n"
-            "Цена порции: *4€*\n"
-            "Код оплаты: `Mimax`"
-        )
-    return (
-        f"🍲 *Iftars — {day} of Ramadan*\n\n"
-        f"{desc}\n\n"
-        f"Goal: *{target} portions*\n"
-        f"Raised: *{raised}* / *{target}*\n"
-        f"{bar}\n\n"
+    ),
+}
+
+IFTAR_TPL = {
+    "ru": (
+        "🍲 *Ифтары — {day} Рамадана*\n\n"
+        "{desc}\n\n"
+        "Цель: *{target} порций*\n"
+        "Собрано: *{raised}* / *{target}*\n"
+        "{bar}\n\n"
+        "Цена порции: *4€*\n"
+        "Код оплаты: `Mimax`"
+    ),
+    "en": (
+        "🍲 *Iftars — {day} of Ramadan*\n\n"
+        "{desc}\n\n"
+        "Goal: *{target} portions*\n"
+        "Raised: *{raised}* / *{target}*\n"
+        "{bar}\n\n"
         "Portion price: *4€*\n"
         "Payment code: `Mimax`"
-    )
+    ),
+}
+
+FITR_TPL = {
+    "ru": (
+        "🕌 *Закят-уль-Фитр (ZF)*\n\n"
+        "{desc}\n\n"
+        "В списке: *{rows}*\n"
+        "Сумма: *{eur}€*\n"
+        "Людей: *{people}*\n"
+        "Рис: *{kg} кг*"
+    ),
+    "en": (
+        "🕌 *Zakat al-Fitr (ZF)*\n\n"
+        "{desc}\n\n"
+        "In list: *{rows}*\n"
+        "Total: *{eur}€*\n"
+        "People: *{people}*\n"
+        "Rice: *{kg} kg*"
+    ),
+}
+
+EID_TPL = {
+    "ru": (
+        "🎁 *Ид — сладости детям (Id)*\n\n"
+        "{desc}\n\n"
+        "Собрано: *{raised}€*\n"
+        "{goal}"
+    ),
+    "en": (
+        "🎁 *Eid sweets for children (Id)*\n\n"
+        "{desc}\n\n"
+        "Raised: *{raised}€*\n"
+        "{goal}"
+    ),
+}
+
+EID_GOAL_TPL = {"ru": "Цель: *{target}€*\n", "en": "Goal: *{target}€*\n"}
+
+async def water_text(lang: str) -> str:
+    target = await kv_get_int("water_target_eur", 235)
+    raised = await kv_get_int("water_raised_eur", 0)
+    return WATER_TPL[lang].format_map({
+        "desc": await kv_get(f"desc_water_{lang}"),
+        "target": target,
+        "raised": raised,
+        "remain": max(0, target - raised),
+        "bar": battery(raised, target),
+    })
+
+async def iftar_text(lang: str) -> str:
+    target = await kv_get_int("iftar_target_portions", 800)
+    raised = await kv_get_int("iftar_raised_portions", 0)
+    return IFTAR_TPL[lang].format_map({
+        "day": await kv_get_int("iftar_day", 27),
+        "desc": await kv_get(f"desc_iftar_{lang}"),
+        "target": target,
+        "raised": raised,
+        "bar": battery(min(raised, target), target),
+    })
 
 async def fitr_text(lang: str) -> str:
-    desc = await kv_get(f"desc_fitr_{lang}")
-    total_eur, total_people, total_kg = await fitr_totals()
-    count_rows = await fitr_count_rows()
-    if lang == "ru":
-        return (
-            "🕌 *Закят-уль-Фитр (ZF)*\n\n"
-            f"{desc}\n\n"
-            f"В списке: *{count_rows}*\n"
-            f"Сумма: *{total_eur}€*\n"
-            f"Людей: *{total_people}*\n"
-            f"Рис: *{total_kg} кг*"
-        )
-    return (
-        "🕌 *Zakat al-Fitr (ZF)*\n\n"
-        f"{desc}\n\n"
-        f"In list: *{count_rows}*\n"
-        f"Total: *{total_eur}€*\n"
-        f"People: *{total_people}*\n"
-        f"Rice: *{total_kg} kg*"
-    )
+    rows, eur, people, kg = await fitr_totals()
+    return FITR_TPL[lang].format_map({
+        "desc": await kv_get(f"desc_fitr_{lang}"),
+        "rows": rows,
+        "eur": eur,
+        "people": people,
+        "kg": kg,
+    })
+
+@lru_cache(maxsize=256)
+def render_fitr_due(lang: str, people: int, price: int) -> str:
+    return tr(lang, "fitr_due", kg=people * 3, eur=people * price, code=f"ZF{people}")
+
+async def fitr_due_text(lang: str, people: int) -> str:
+    # price is part of the cache key, so /fitr price needs no invalidation
+    return render_fitr_due(lang, people, await kv_get_int("fitr_saa_eur", 10))
 
 async def eid_text(lang: str) -> str:
-    desc = await kv_get(f"desc_eid_{lang}")
-    raised = int(await kv_get("eid_raised_eur") or "0")
-    target = int(await kv_get("eid_target_eur") or "0")
-    if lang == "ru":
-        s = (
-            "🎁 *Ид — сладости детям (Id)*\n\n"
-            f"{desc}\n\n"
-            f"Собрано: *{raised}€*\n"
-        )
-        if target > 0:
-            s += f"Цель: *{target}€*\n"
-        return s
-    s = (
-        "🎁 *Eid sweets for children (Id)*\n\n"
-        f"{desc}\n\n"
-        f"Raised: *{raised}€*\n"
-    )
-    if target > 0:
-        s += f"Goal: *{target}€*\n"
-    return s
+    target = await kv_get_int("eid_target_eur", 0)
+    return EID_TPL[lang].format_map({
+        "desc": await kv_get(f"desc_eid_{lang}"),
+        "raised": await kv_get_int("eid_raised_eur", 0),
+        "goal": EID_GOAL_TPL[lang].format(target=target) if target > 0 else "",
+    })
+
+
+# =========================
+# Callback data
+# =========================
+
+# Opening a campaign and "Back" to it are the same screen.
+class CampaignCB(CallbackData, prefix="camp"):
+    campaign: str
+
+class FitrPeopleCB(CallbackData, prefix="fitr_people"):
+    count: int
+
+class FitrMethodCB(CallbackData, prefix="fitr_method"):
+    method: str
+
+class ManualSentCB(CallbackData, prefix="manual_sent"):
+    method: str
+    campaign: str
+    amount_eur: int
+    note: str
+
+class CopyNoteCB(CallbackData, prefix="copy_note"):
+    note: str
+
+
+# =========================
+# States
+# =========================
+
+class FitrInput(StatesGroup):
+    people = State()
+
+class FitrIdentity(StatesGroup):
+    fmt = State()
+    name = State()
+    country = State()
+    city = State()
+
+class AdminInput(StatesGroup):
+    edit_text = State()
 
 
 # =========================
 # Keyboards
 # =========================
 
+@lru_cache(maxsize=None)
 def kb_lang_select():
     kb = InlineKeyboardBuilder()
     kb.button(text="Русский", callback_data="lang_ru")
@@ -508,18 +932,23 @@ def kb_lang_select():
     kb.adjust(2)
     return kb.as_markup()
 
+@lru_cache(maxsize=None)
 def kb_campaigns(lang: str, show_fitr: bool, show_eid: bool):
     kb = InlineKeyboardBuilder()
-    kb.button(text=t(lang, "💧 Вода (Greenmax)", "💧 Water (Greenmax)"), callback_data="camp_water")
-    kb.button(text=t(lang, "🍲 Ифтары (Mimax)", "🍲 Iftars (Mimax)"), callback_data="camp_iftar")
+    kb.button(text=t(lang, "💧 Вода (Greenmax)", "💧 Water (Greenmax)"), callback_data=CampaignCB(campaign="water"))
+    kb.button(text=t(lang, "🍲 Ифтары (Mimax)", "🍲 Iftars (Mimax)"), callback_data=CampaignCB(campaign="iftar"))
     if show_fitr:
-        kb.button(text=t(lang, "🕌 Закят-уль-Фитр (ZF)", "🕌 Zakat al-Fitr (ZF)"), callback_data="camp_fitr")
+        kb.button(text=t(lang, "🕌 Закят-уль-Фитр (ZF)", "🕌 Zakat al-Fitr (ZF)"), callback_data=CampaignCB(campaign="fitr"))
     if show_eid:
-        kb.button(text=t(lang, "🎁 Ид — сладости детям (Id)", "🎁 Eid sweets (Id)"), callback_data="camp_eid")
+        kb.button(text=t(lang, "🎁 Ид — сладости детям (Id)", "🎁 Eid sweets (Id)"), callback_data=CampaignCB(campaign="eid"))
     kb.button(text=t(lang, "🌐 Язык", "🌐 Language"), callback_data="go_lang")
     kb.adjust(1)
     return kb.as_markup()
 
+async def campaigns_kb(lang: str):
+    return kb_campaigns(lang, await is_fitr_visible(), await is_eid_open())
+
+@lru_cache(maxsize=None)
 def kb_admin_tools(lang: str, campaign: str):
     kb = InlineKeyboardBuilder()
     kb.button(text=t(lang, "✏️ Править RU", "✏️ Edit RU"), callback_data=f"admin_edit|{campaign}|ru")
@@ -528,10 +957,11 @@ def kb_admin_tools(lang: str, campaign: str):
     kb.adjust(1)
     return kb.as_markup()
 
+@lru_cache(maxsize=None)
 def kb_fitr_members(lang: str):
     kb = InlineKeyboardBuilder()
     for n in [1, 2, 3, 4, 5]:
-        kb.button(text=t(lang, f"{n} человек", f"{n} people"), callback_data=f"fitr_people_{n}")
+        kb.button(text=tr(lang, "people_n", n=n), callback_data=FitrPeopleCB(count=n))
     kb.button(text=t(lang, "Другое количество", "Other qty"), callback_data="fitr_people_other")
     kb.button(text=t(lang, "Способы оплаты", "Payment methods"), callback_data="fitr_methods")
     kb.button(text=t(lang, "Назад", "Back"), callback_data="go_campaigns")
@@ -539,46 +969,55 @@ def kb_fitr_members(lang: str):
     kb.adjust(2, 2, 1, 1, 1)
     return kb.as_markup()
 
+@lru_cache(maxsize=None)
 def kb_fitr_methods(lang: str):
     kb = InlineKeyboardBuilder()
-    kb.button(text="💙 PayPal", callback_data="fitr_method_paypal")
-    kb.button(text=t(lang, "🏦 Zen перевод", "🏦 Zen bank"), callback_data="fitr_method_zenbank")
-    kb.button(text=t(lang, "⚡ Zen Express", "⚡ Zen Express"), callback_data="fitr_method_zenfast")
-    kb.button(text=t(lang, "Назад", "Back"), callback_data="camp_fitr")
+    kb.button(text="💙 PayPal", callback_data=FitrMethodCB(method="paypal"))
+    kb.button(text=t(lang, "🏦 Zen перевод", "🏦 Zen bank"), callback_data=FitrMethodCB(method="zenbank"))
+    kb.button(text=t(lang, "⚡ Zen Express", "⚡ Zen Express"), callback_data=FitrMethodCB(method="zenfast"))
+    kb.button(text=t(lang, "Назад", "Back"), callback_data=CampaignCB(campaign="fitr"))
     kb.button(text=t(lang, "Сброс", "Reset"), callback_data="reset_flow")
     kb.adjust(1)
     return kb.as_markup()
 
+def _detail_buttons(*buttons: tuple[str, str, str, object]) -> list[tuple[str, str, str]]:
+    # (ru, en, callback, value) -> (ru, en, callback) for the details that are configured
+    return [(ru, en, data) for ru, en, data, value in buttons if value]
+
+# method -> detail buttons, fixed at import since the env values never change
+PAYMENT_DETAIL_BUTTONS: dict[str, list[tuple[str, str, str]]] = {
+    "paypal": _detail_buttons(
+        ("💙 Ссылка PayPal", "💙 PayPal link", "show_paypal_link", True),
+    ),
+    "zenbank": _detail_buttons(
+        ("👤 Получатель", "👤 Recipient", "show_zen_name", True),
+        ("🏦 IBAN", "🏦 IBAN", "show_zen_iban", True),
+        ("BIC", "BIC", "show_zen_bic", CFG.zen_bic),
+    ),
+    "zenfast": _detail_buttons(
+        ("📱 Телефон", "📱 Phone", "show_zen_phone", CFG.zen_phone),
+        ("💳 Карта", "💳 Card", "show_zen_card", CFG.zen_card),
+        ("👤 Получатель", "👤 Recipient", "show_zen_name", CFG.zen_name),
+    ),
+    "sepa": _detail_buttons(
+        ("👤 Получатель", "👤 Recipient", "show_sepa_recipient", True),
+        ("🏦 IBAN", "🏦 IBAN", "show_sepa_iban", True),
+        ("BIC", "BIC", "show_sepa_bic", CFG.sepa_bic),
+    ),
+}
+
 def kb_hidden_payment_details(lang: str, campaign: str, method: str, amount_eur: int, note: str):
     kb = InlineKeyboardBuilder()
-
-    if method == "paypal":
-        kb.button(text=t(lang, "💙 Ссылка PayPal", "💙 PayPal link"), callback_data="show_paypal_link")
-    elif method == "zenbank":
-        kb.button(text=t(lang, "👤 Получатель", "👤 Recipient"), callback_data="show_zen_name")
-        kb.button(text=t(lang, "🏦 IBAN", "🏦 IBAN"), callback_data="show_zen_iban")
-        if ZEN_BIC:
-            kb.button(text="BIC", callback_data="show_zen_bic")
-    elif method == "zenfast":
-        if ZEN_PHONE:
-            kb.button(text=t(lang, "📱 Телефон", "📱 Phone"), callback_data="show_zen_phone")
-        if ZEN_CARD:
-            kb.button(text=t(lang, "💳 Карта", "💳 Card"), callback_data="show_zen_card")
-        if ZEN_NAME:
-            kb.button(text=t(lang, "👤 Получатель", "👤 Recipient"), callback_data="show_zen_name")
-    elif method == "sepa":
-        kb.button(text=t(lang, "👤 Получатель", "👤 Recipient"), callback_data="show_sepa_recipient")
-        kb.button(text=t(lang, "🏦 IBAN", "🏦 IBAN"), callback_data="show_sepa_iban")
-        if SEPA_BIC:
-            kb.button(text="BIC", callback_data="show_sepa_bic")
-
-    kb.button(text=t(lang, "📋 Скопировать код", "📋 Copy code"), callback_data=f"copy_note|{note}")
-    kb.button(text=t(lang, "✅ Оплатил", "✅ Paid"), callback_data=f"manual_sent|{method}|{campaign}|{amount_eur}|{note}")
-    kb.button(text=t(lang, "Назад", "Back"), callback_data=f"back_to_{campaign}")
+    for ru, en, data in PAYMENT_DETAIL_BUTTONS.get(method, ()):
+        kb.button(text=t(lang, ru, en), callback_data=data)
+    kb.button(text=t(lang, "📋 Скопировать код", "📋 Copy code"), callback_data=CopyNoteCB(note=note))
+    kb.button(text=t(lang, "✅ Оплатил", "✅ Paid"), callback_data=ManualSentCB(method=method, campaign=campaign, amount_eur=amount_eur, note=note))
+    kb.button(text=t(lang, "Назад", "Back"), callback_data=CampaignCB(campaign=campaign))
     kb.button(text=t(lang, "Сброс", "Reset"), callback_data="reset_flow")
     kb.adjust(1)
     return kb.as_markup()
 
+@lru_cache(maxsize=None)
 def kb_fitr_name_format(lang: str):
     kb = InlineKeyboardBuilder()
     kb.button(text=t(lang, "Умм …", "Umm …"), callback_data="fitr_fmt_umm")
@@ -597,59 +1036,56 @@ def kb_fitr_name_format(lang: str):
 async def start(message: Message):
     lang = await get_user_lang(message.from_user.id)
     if not lang:
-        await message.answer("Мир вам! Выберите язык дальнейшего общения", reply_markup=kb_lang_select())
+        await message.answer(WELCOME_TEXT, reply_markup=kb_lang_select())
         return
-    show_fitr = await is_fitr_visible()
-    show_eid = await is_eid_open()
-    await message.answer(t(lang, "Выберите сбор:", "Choose campaign:"), reply_markup=kb_campaigns(lang, show_fitr, show_eid))
+    await message.answer(t(lang, *CHOOSE_CAMPAIGN_TEXT), reply_markup=await campaigns_kb(lang))
 
 @dp.callback_query(F.data.in_({"lang_ru", "lang_en"}))
 async def choose_lang(call: CallbackQuery):
     lang = "ru" if call.data == "lang_ru" else "en"
     await set_user_lang(call.from_user.id, lang)
-    await call.answer()
-    show_fitr = await is_fitr_visible()
-    show_eid = await is_eid_open()
-    await safe_edit(call, t(lang, "Выберите сбор:", "Choose campaign:"), reply_markup=kb_campaigns(lang, show_fitr, show_eid))
+    ack(call)
+    await safe_edit(call, t(lang, *CHOOSE_CAMPAIGN_TEXT), reply_markup=await campaigns_kb(lang))
 
 @dp.callback_query(F.data.in_({"go_lang", "go_campaigns", "reset_flow"}))
-async def basic_nav(call: CallbackQuery):
+async def basic_nav(call: CallbackQuery, state: FSMContext):
     lang = await get_user_lang(call.from_user.id) or "ru"
-    PENDING.pop(call.from_user.id, None)
-    await call.answer()
+    await state.clear()
+    ack(call)
     if call.data == "go_lang":
-        await safe_edit(call, "Мир вам! Выберите язык дальнейшего общения", reply_markup=kb_lang_select())
+        await safe_edit(call, WELCOME_TEXT, reply_markup=kb_lang_select())
         return
-    show_fitr = await is_fitr_visible()
-    show_eid = await is_eid_open()
-    await safe_edit(call, t(lang, "Выберите сбор:", "Choose campaign:"), reply_markup=kb_campaigns(lang, show_fitr, show_eid))
-
-@dp.callback_query(F.data.in_({"camp_water", "camp_iftar", "camp_fitr", "camp_eid"}))
-async def open_campaign(call: CallbackQuery):
+    await safe_edit(call, t(lang, *CHOOSE_CAMPAIGN_TEXT), reply_markup=await campaigns_kb(lang))
+
+# campaign -> (text builder, user keyboard builder or None)
+CAMPAIGN_SCREENS = {
+    "water": (water_text, None),
+    "iftar": (iftar_text, None),
+    "fitr": (fitr_text, kb_fitr_members),
+    "eid": (eid_text, None),
+}
+
+async def campaign_text(campaign: str, lang: str) -> str:
+    text = SCREEN_CACHE.get((campaign, lang))
+    if text is None:
+        version = SCREEN_VERSION
+        text = await CAMPAIGN_SCREENS[campaign][0](lang)
+        if version == SCREEN_VERSION:
+            SCREEN_CACHE[(campaign, lang)] = text
+    return text
+
+async def show_campaign(call: CallbackQuery, campaign: str):
     lang = await get_user_lang(call.from_user.id) or "ru"
-    await call.answer()
-
-    if call.data == "camp_fitr":
-        await safe_edit(call, await fitr_text(lang), parse_mode="Markdown", reply_markup=kb_fitr_members(lang))
-        if admin_only(call.from_user.id):
-            await call.message.answer("Admin", reply_markup=kb_admin_tools(lang, "fitr"))
-        return
-
-    if call.data == "camp_water":
-        await safe_edit(call, await water_text(lang), parse_mode="Markdown")
-        if admin_only(call.from_user.id):
-            await call.message.answer("Admin", reply_markup=kb_admin_tools(lang, "water"))
-        return
-
-    if call.data == "camp_iftar":
-        await safe_edit(call, await iftar_text(lang), parse_mode="Markdown")
-        if admin_only(call.from_user.id):
-            await call.message.answer("Admin", reply_markup=kb_admin_tools(lang, "iftar"))
-        return
-
-    await safe_edit(call, await eid_text(lang), parse_mode="Markdown")
+    build_kb = CAMPAIGN_SCREENS[campaign][1]
+    reply_markup = build_kb(lang) if build_kb else None
+    await safe_edit(call, await campaign_text(campaign, lang), parse_mode="Markdown", reply_markup=reply_markup)
     if admin_only(call.from_user.id):
-        await call.message.answer("Admin", reply_markup=kb_admin_tools(lang, "eid"))
+        await call.message.answer("Admin", reply_markup=kb_admin_tools(lang, campaign))
+
+@dp.callback_query(CampaignCB.filter(F.campaign.in_(CAMPAIGN_SCREENS.keys())))
+async def open_campaign(call: CallbackQuery, callback_data: CampaignCB):
+    ack(call)
+    await show_campaign(call, callback_data.campaign)
 
 
 # =========================
@@ -659,42 +1095,36 @@ async def open_campaign(call: CallbackQuery):
 @dp.callback_query(F.data == "fitr_methods")
 async def fitr_methods(call: CallbackQuery):
     lang = await get_user_lang(call.from_user.id) or "ru"
-    await call.answer()
+    ack(call)
     await call.message.answer(t(lang, "Выберите способ оплаты:", "Choose payment method:"), reply_markup=kb_fitr_methods(lang))
 
-@dp.callback_query(F.data.startswith("fitr_people_"))
-async def fitr_people(call: CallbackQuery):
+@dp.callback_query(F.data == "fitr_people_other")
+async def fitr_people_other(call: CallbackQuery, state: FSMContext):
     lang = await get_user_lang(call.from_user.id) or "ru"
-    await call.answer()
+    ack(call)
+    await state.set_state(FitrInput.people)
+    await call.message.answer(t(lang, *ENTER_NUMBER_TEXT))
 
-    if call.data == "fitr_people_other":
-        PENDING[call.from_user.id] = {"kind": "fitr_people_other"}
-        await call.message.answer(t(lang, "Введите только число. Пример: 5", "Enter only a number. Example: 5"))
-        return
-
-    people = int(call.data.split("_")[-1])
-    PENDING[call.from_user.id] = {"fitr_people": people}
-    price = int(await kv_get("fitr_saa_eur") or "10")
-    eur = people * price
-    kg = people * 3
-    code = f"ZF{people}"
+@dp.callback_query(FitrPeopleCB.filter())
+async def fitr_people(call: CallbackQuery, callback_data: FitrPeopleCB, state: FSMContext):
+    lang = await get_user_lang(call.from_user.id) or "ru"
+    ack(call)
+    people = callback_data.count
+    await state.set_state(None)
+    await state.set_data({"fitr_people": people})
     await call.message.answer(
-        t(
-            lang,
-            f"Вам необходимо раздать: *{kg} кг*\nСумма к оплате: *{eur}€*\nКод оплаты: `{code}`",
-            f"You need to distribute: *{kg} kg*\nAmount to pay: *{eur}€*\nPayment code: `{code}`"
-        ),
+        await fitr_due_text(lang, people),
         parse_mode="Markdown",
         reply_markup=kb_fitr_methods(lang)
     )
 
-@dp.callback_query(F.data.startswith("fitr_method_"))
-async def fitr_method(call: CallbackQuery):
+@dp.callback_query(FitrMethodCB.filter())
+async def fitr_method(call: CallbackQuery, callback_data: FitrMethodCB, state: FSMContext):
     lang = await get_user_lang(call.from_user.id) or "ru"
-    method = call.data.replace("fitr_method_", "")
-    people = PENDING.get(call.from_user.id, {}).get("fitr_people")
+    method = callback_data.method
+    people = (await state.get_data()).get("fitr_people")
 
-    await call.answer()
+    ack(call)
 
     if not people:
         await call.message.answer(t(lang, "Сначала выберите количество людей.", "Choose number of people first."))
@@ -704,57 +1134,50 @@ async def fitr_method(call: CallbackQuery):
         await call.message.answer(fitr_close_text(method, lang))
         return
 
-    price = int(await kv_get("fitr_saa_eur") or "10")
+    price = await kv_get_int("fitr_saa_eur", 10)
     eur = people * price
     code = f"ZF{people}"
 
     await call.message.answer(
-        t(
-            lang,
-            f"Сумма к оплате: *{eur}€*\nКод оплаты: `{code}`",
-            f"Amount to pay: *{eur}€*\nPayment code: `{code}`"
-        ),
+        tr(lang, "fitr_pay", eur=eur, code=code),
         parse_mode="Markdown",
         reply_markup=kb_hidden_payment_details(lang, "fitr", method, eur, code)
     )
 
-@dp.callback_query(F.data.startswith("manual_sent|"))
-async def manual_sent(call: CallbackQuery):
+@dp.callback_query(ManualSentCB.filter())
+async def manual_sent(call: CallbackQuery, callback_data: ManualSentCB, state: FSMContext):
     lang = await get_user_lang(call.from_user.id) or "ru"
-    await call.answer()
+    ack(call)
 
-    _, method, campaign, amount_eur, note = call.data.split("|", 4)
-    amount_eur = int(amount_eur)
+    method, campaign = callback_data.method, callback_data.campaign
+    amount_eur, note = callback_data.amount_eur, callback_data.note
 
     if campaign == "fitr":
         people = parse_fitr_code(note) or max(1, amount_eur // 10)
-        PENDING[call.from_user.id] = {
-            "kind": "fitr_identity",
+        await state.set_state(FitrIdentity.fmt)
+        await state.set_data({
             "method": method,
             "amount_eur": amount_eur,
             "people_count": people,
             "code": note,
-        }
+        })
         await call.message.answer(
             t(lang, "Чтобы вы видели себя в списке на раздачу фитра, выберите формат.", "Choose how you want to appear in the fitr list."),
             reply_markup=kb_fitr_name_format(lang)
         )
         return
 
-    await call.message.answer("🌸 Джазак Аллаху хейр! Пусть ваши благие дела станут ключом к вратам Рая 🤍")
+    await call.message.answer(THANKS_TEXT)
 
-@dp.callback_query(F.data.in_({"fitr_fmt_umm", "fitr_fmt_abu", "fitr_fmt_name"}))
-async def fitr_format_choice(call: CallbackQuery):
+# name format button -> fmt stored for the identity flow
+FITR_NAME_FORMATS = {"fitr_fmt_umm": "umm", "fitr_fmt_abu": "abu", "fitr_fmt_name": "name"}
+
+@dp.callback_query(F.data.in_(FITR_NAME_FORMATS.keys()), StateFilter(FitrIdentity))
+async def fitr_format_choice(call: CallbackQuery, state: FSMContext):
     lang = await get_user_lang(call.from_user.id) or "ru"
-    ctx = PENDING.get(call.from_user.id)
-    if not ctx or ctx.get("kind") != "fitr_identity":
-        await call.answer()
-        return
-    mapping = {"fitr_fmt_umm": "umm", "fitr_fmt_abu": "abu", "fitr_fmt_name": "name"}
-    ctx["fmt"] = mapping[call.data]
-    ctx["step"] = "name"
-    PENDING[call.from_user.id] = ctx
-    await call.answer()
+    await state.update_data(fmt=FITR_NAME_FORMATS[call.data])
+    await state.set_state(FitrIdentity.name)
+    ack(call)
     await call.message.answer(t(lang, "Имя или инициалы (обязательно):", "Name or initials (required):"))
 
 
@@ -762,163 +1185,130 @@ async def fitr_format_choice(call: CallbackQuery):
 # Hidden values
 # =========================
 
-@dp.callback_query(F.data.in_({
-    "show_paypal_link",
-    "show_zen_name", "show_zen_iban", "show_zen_bic", "show_zen_phone", "show_zen_card",
-    "show_sepa_recipient", "show_sepa_iban", "show_sepa_bic",
-}))
+def _hidden_reply(value: str) -> dict[str, str]:
+    if not value:
+        return {"ru": "Не настроено.", "en": "Not configured."}
+    return {"ru": f"`{value}`", "en": f"`{value}`"}
+
+HIDDEN_REPLIES: dict[str, dict[str, str]] = {
+    "show_paypal_link": _hidden_reply(CFG.paypal_link),
+    "show_zen_name": _hidden_reply(CFG.zen_name),
+    "show_zen_iban": _hidden_reply(CFG.zen_iban),
+    "show_zen_bic": _hidden_reply(CFG.zen_bic),
+    "show_zen_phone": _hidden_reply(CFG.zen_phone),
+    "show_zen_card": _hidden_reply(CFG.zen_card),
+    "show_sepa_recipient": _hidden_reply(CFG.sepa_recipient),
+    "show_sepa_iban": _hidden_reply(CFG.sepa_iban),
+    "show_sepa_bic": _hidden_reply(CFG.sepa_bic),
+}
+
+@dp.callback_query(F.data.in_(HIDDEN_REPLIES.keys()))
 async def show_hidden_detail(call: CallbackQuery):
     lang = await get_user_lang(call.from_user.id) or "ru"
-    await call.answer()
-
-    mapping = {
-        "show_paypal_link": PAYPAL_LINK,
-        "show_zen_name": ZEN_NAME,
-        "show_zen_iban": ZEN_IBAN,
-        "show_zen_bic": ZEN_BIC,
-        "show_zen_phone": ZEN_PHONE,
-        "show_zen_card": ZEN_CARD,
-        "show_sepa_recipient": SEPA_RECIPIENT,
-        "show_sepa_iban": SEPA_IBAN,
-        "show_sepa_bic": SEPA_BIC,
-    }
-    val = mapping.get(call.data, "")
-    if not val:
-        await call.message.answer(t(lang, "Не настроено.", "Not configured."))
-        return
-    await call.message.answer(f"`{val}`", parse_mode="Markdown")
-
-@dp.callback_query(F.data.startswith("copy_note|"))
-async def copy_note(call: CallbackQuery):
-    await call.answer()
-    note = call.data.split("|", 1)[1]
-    await call.message.answer(f"`{note}`", parse_mode="Markdown")
-
-@dp.callback_query(F.data.in_({"back_to_fitr", "back_to_water", "back_to_iftar", "back_to_eid"}))
-async def back_to_campaign_short(call: CallbackQuery):
-    await call.answer()
-    target = call.data.replace("back_to_", "")
-    mapping = {
-        "fitr": "camp_fitr",
-        "water": "camp_water",
-        "iftar": "camp_iftar",
-        "eid": "camp_eid",
-    }
-    fake = CallbackQuery(
-        id=call.id,
-        from_user=call.from_user,
-        chat_instance=call.chat_instance,
-        message=call.message,
-        data=mapping[target]
-    )
-    await open_campaign(fake)
+    ack(call)
+    await call.message.answer(HIDDEN_REPLIES[call.data][lang], parse_mode="Markdown")
+
+@dp.callback_query(CopyNoteCB.filter())
+async def copy_note(call: CallbackQuery, callback_data: CopyNoteCB):
+    ack(call)
+    await call.message.answer(f"`{callback_data.note}`", parse_mode="Markdown")
 
 
 # =========================
 # Text input states
 # =========================
 
-@dp.message(F.text)
-async def text_input(message: Message):
-    lang = await get_user_lang(message.from_user.id) or "ru"
-    ctx = PENDING.get(message.from_user.id)
-    if not ctx:
-        return
-
-    raw = (message.text or "").strip()
+@dp.message(F.text, AdminInput.edit_text)
+async def edit_text_input(message: Message, state: FSMContext):
+    raw = message.text.strip()
+    key = (await state.get_data())["key"]
+    await kv_set_text(key, raw)
+    await state.clear()
+    await message.answer("OK")
 
-    if ctx["kind"] == "edit_text":
-        key = ctx["key"]
-        old_v = await kv_get(key)
-        await kv_set(key, raw)
-        await add_text_history(key, old_v, raw)
-        PENDING.pop(message.from_user.id, None)
-        await message.answer("OK")
+@dp.message(F.text, FitrInput.people)
+async def fitr_people_other_input(message: Message, state: FSMContext):
+    lang = await get_user_lang(message.from_user.id) or "ru"
+    n = extract_positive_int(message.text.strip())
+    if not n:
+        await message.answer(t(lang, *ENTER_NUMBER_TEXT))
         return
+    await state.set_state(None)
+    await state.set_data({"fitr_people": n})
+    await message.answer(
+        await fitr_due_text(lang, n),
+        parse_mode="Markdown",
+        reply_markup=kb_fitr_methods(lang)
+    )
 
-    if ctx["kind"] == "fitr_people_other":
-        n = extract_positive_int(raw)
-        if not n:
-            await message.answer(t(lang, "Введите только число. Пример: 5", "Enter only a number. Example: 5"))
-            return
-        PENDING[message.from_user.id] = {"fitr_people": n}
-        price = int(await kv_get("fitr_saa_eur") or "10")
-        eur = n * price
-        kg = n * 3
-        code = f"ZF{n}"
-        await message.answer(
-            t(
-                lang,
-                f"Вам необходимо раздать: *{kg} кг*\nСумма к оплате: *{eur}€*\nКод оплаты: `{code}`",
-                f"You need to distribute: *{kg} kg*\nAmount to pay: *{eur}€*\nPayment code: `{code}`"
-            ),
-            parse_mode="Markdown",
-            reply_markup=kb_fitr_methods(lang)
-        )
+@dp.message(F.text, FitrIdentity.name)
+async def fitr_name_input(message: Message, state: FSMContext):
+    lang = await get_user_lang(message.from_user.id) or "ru"
+    raw = message.text.strip()
+    if not raw:
+        await message.answer(t(lang, "Введите имя или инициалы.", "Enter name or initials."))
         return
+    await state.update_data(name=raw)
+    await state.set_state(FitrIdentity.country)
+    await message.answer(t(lang, "Страна? Если не хотите указывать, отправьте -", "Country? Send - to skip"))
 
-    if ctx["kind"] == "fitr_identity":
-        if ctx.get("step") == "name":
-            if not raw:
-                await message.answer(t(lang, "Введите имя или инициалы.", "Enter name or initials."))
-                return
-            ctx["name"] = raw
-            ctx["step"] = "country"
-            PENDING[message.from_user.id] = ctx
-            await message.answer(t(lang, "Страна? Если не хотите указывать, отправьте -", "Country? Send - to skip"))
-            return
-
-        if ctx.get("step") == "country":
-            ctx["country"] = "" if raw == "-" else raw
-            ctx["step"] = "city"
-            PENDING[message.from_user.id] = ctx
-            await message.answer(t(lang, "Город? Если не хотите указывать, отправьте -", "City? Send - to skip"))
-            return
-
-        if ctx.get("step") == "city":
-            city = "" if raw == "-" else raw
-            fmt = ctx.get("fmt", "name")
-            name = ctx.get("name", "")
-            country = ctx.get("country", "")
-
-            if fmt == "umm":
-                display_name = f"Умм {name}" if lang == "ru" else f"Umm {name}"
-            elif fmt == "abu":
-                display_name = f"Абу {name}" if lang == "ru" else f"Abu {name}"
-            else:
-                display_name = name
-
-            row_id = await add_fitr_person(
-                message.from_user.id,
-                message.from_user.username or "",
-                ctx["method"],
-                display_name,
-                country,
-                city,
-                int(ctx["people_count"]),
-                int(ctx["amount_eur"]),
-                ctx["code"],
-                "",
-            )
-            await fitr_report_if_needed()
-            PENDING.pop(message.from_user.id, None)
-
-            total_eur, total_people, total_kg = await fitr_totals()
-            await notify_admin(
-                "📩 FITR LIST UPDATED\n"
-                f"№: {row_id}\n"
-                f"Name: {display_name}\n"
-                f"Country: {country or '-'}\n"
-                f"City: {city or '-'}\n"
-                f"Method: {ctx['method']}\n"
-                f"Amount: {ctx['amount_eur']} EUR\n"
-                f"People: {ctx['people_count']}\n"
-                f"Kg: {int(ctx['people_count']) * 3}\n"
-                f"Code: {ctx['code']}\n\n"
-                f"TOTALS -> EUR: {total_eur}, PEOPLE: {total_people}, KG: {total_kg}"
-            )
-            await message.answer("🌸 Джазак Аллаху хейр! Пусть ваши благие дела станут ключом к вратам Рая 🤍")
-            return
+@dp.message(F.text, FitrIdentity.country)
+async def fitr_country_input(message: Message, state: FSMContext):
+    lang = await get_user_lang(message.from_user.id) or "ru"
+    raw = message.text.strip()
+    await state.update_data(country="" if raw == "-" else raw)
+    await state.set_state(FitrIdentity.city)
+    await message.answer(t(lang, "Город? Если не хотите указывать, отправьте -", "City? Send - to skip"))
+
+# (fmt, lang) -> prefix in front of the donor's name; "name" has none
+FITR_NAME_PREFIXES = {
+    ("umm", "ru"): "Умм ",
+    ("umm", "en"): "Umm ",
+    ("abu", "ru"): "Абу ",
+    ("abu", "en"): "Abu ",
+}
+
+@dp.message(F.text, FitrIdentity.city)
+async def fitr_city_input(message: Message, state: FSMContext):
+    lang = await get_user_lang(message.from_user.id) or "ru"
+    raw = message.text.strip()
+    ctx = await state.get_data()
+    city = "" if raw == "-" else raw
+    fmt = ctx.get("fmt", "name")
+    name = ctx.get("name", "")
+    country = ctx.get("country", "")
+
+    display_name = FITR_NAME_PREFIXES.get((fmt, lang), "") + name
+
+    row_id = await add_fitr_person(
+        message.from_user.id,
+        message.from_user.username or "",
+        ctx["method"],
+        display_name,
+        country,
+        city,
+        int(ctx["people_count"]),
+        int(ctx["amount_eur"]),
+        ctx["code"],
+        "",
+    )
+    _, total_eur, total_people, total_kg = await fitr_report_if_needed()
+    await state.clear()
+
+    await notify_admin(
+        "📩 FITR LIST UPDATED\n"
+        f"№: {row_id}\n"
+        f"Name: {display_name}\n"
+        f"Country: {country or '-'}\n"
+        f"City: {city or '-'}\n"
+        f"Method: {ctx['method']}\n"
+        f"Amount: {ctx['amount_eur']} EUR\n"
+        f"People: {ctx['people_count']}\n"
+        f"Kg: {int(ctx['people_count']) * 3}\n"
+        f"Code: {ctx['code']}\n\n"
+        f"TOTALS -> EUR: {total_eur}, PEOPLE: {total_people}, KG: {total_kg}"
+    )
+    await message.answer(THANKS_TEXT)
 
 
 # =========================
@@ -929,137 +1319,117 @@ async def text_input(message: Message):
 async def pre_checkout(pre: PreCheckoutQuery):
     await bot.answer_pre_checkout_query(pre.id, ok=True)
 
-@dp.message(lambda m: getattr(m, "successful_payment", None) is not None)
+@dp.message(F.successful_payment)
 async def successful_payment(message: Message):
-    await message.answer("🌸 Джазак Аллаху хейр! Пусть ваши благие дела станут ключом к вратам Рая 🤍")
+    charge_id = message.successful_payment.telegram_payment_charge_id
+    if charge_id in SEEN_PAYMENTS:
+        return
+    await message.answer(THANKS_TEXT)
+    # Marked only once the reply went out, so a redelivery after a failed send is handled again.
+    SEEN_PAYMENTS[charge_id] = True
 
 
 # =========================
 # Admin commands
 # =========================
 
-@dp.message(Command("admin"))
+ADMIN_HELP = (
+    "/fitr\n"
+    "/iftars\n"
+    "/water\n"
+    "/eid\n\n"
+    "/fitr text\n"
+    "/fitr list\n"
+    "/fitr add Имя;ZF5;paypal;Страна;Город;коммент\n"
+    "/fitr edit ID;Имя;ZF5;paypal;Страна;Город;коммент\n"
+    "/fitr del ID\n"
+    "/fitr find ТЕКСТ\n"
+    "/fitr dup\n"
+    "/fitr price 10\n\n"
+    "/undo\n"
+)
+
+@admin_router.message(Command("admin"))
 async def cmd_admin(message: Message):
-    if not admin_only(message.from_user.id):
-        return
-    txt = (
-        "/fitr\n"
-        "/iftars\n"
-        "/water\n"
-        "/eid\n\n"
-        "/fitr text\n"
-        "/fitr list\n"
-        "/fitr add Имя;ZF5;paypal;Страна;Город;коммент\n"
-        "/fitr edit ID;Имя;ZF5;paypal;Страна;Город;коммент\n"
-        "/fitr del ID\n"
-        "/fitr find ТЕКСТ\n"
-        "/fitr dup\n"
-        "/fitr price 10\n\n"
-        "/undo\n"
-    )
-    await message.answer(txt)
+    await message.answer(ADMIN_HELP)
 
-@dp.message(Command("undo"))
+@admin_router.message(Command("undo"))
 async def cmd_undo(message: Message):
-    if not admin_only(message.from_user.id):
-        return
     ok = await undo_last_text_change()
     await message.answer("OK" if ok else "No changes")
 
-@dp.message(Command("fitr"))
-async def cmd_fitr_admin_short(message: Message):
-    lang = await get_user_lang(message.from_user.id) or "ru"
-    await message.answer(await fitr_text(lang), parse_mode="Markdown", reply_markup=kb_fitr_members(lang))
+# command -> campaign
+CAMPAIGN_COMMANDS = {"fitr": "fitr", "iftars": "iftar", "water": "water", "eid": "eid"}
 
-@dp.message(Command("iftars"))
-async def cmd_iftars_admin_short(message: Message):
+# Bare commands only: "/fitr list" etc. must reach the admin handlers below.
+@admin_router.message(Command(*CAMPAIGN_COMMANDS, magic=F.args.is_(None)))
+async def cmd_campaign_short(message: Message, command: CommandObject):
     lang = await get_user_lang(message.from_user.id) or "ru"
-    await message.answer(await iftar_text(lang), parse_mode="Markdown")
+    campaign = CAMPAIGN_COMMANDS[command.command]
+    build_kb = CAMPAIGN_SCREENS[campaign][1]
+    reply_markup = build_kb(lang) if build_kb else None
+    await message.answer(await campaign_text(campaign, lang), parse_mode="Markdown", reply_markup=reply_markup)
 
-@dp.message(Command("water"))
-async def cmd_water_admin_short(message: Message):
-    lang = await get_user_lang(message.from_user.id) or "ru"
-    await message.answer(await water_text(lang), parse_mode="Markdown")
-
-@dp.message(Command("eid"))
-async def cmd_eid_admin_short(message: Message):
-    lang = await get_user_lang(message.from_user.id) or "ru"
-    await message.answer(await eid_text(lang), parse_mode="Markdown")
-
-@dp.message(F.text.regexp(r"^/fitr\s+text$"))
-async def admin_fitr_text(message: Message):
-    if not admin_only(message.from_user.id):
-        return
+@admin_router.message(F.text.regexp(r"^/fitr\s+text$"))
+async def admin_fitr_text(message: Message, state: FSMContext):
     key = "desc_fitr_ru"
     current = await kv_get(key)
-    PENDING[message.from_user.id] = {"kind": "edit_text", "key": key}
+    await state.set_state(AdminInput.edit_text)
+    await state.set_data({"key": key})
     await message.answer(f"Текущий текст:\n\n{current}\n\nОтправьте новый текст одним сообщением.")
 
-@dp.message(F.text.regexp(r"^/fitr\s+price\s+\d+$"))
+@admin_router.message(F.text.regexp(r"^/fitr\s+price\s+\d+$"))
 async def admin_fitr_price(message: Message):
-    if not admin_only(message.from_user.id):
+    n = parse_int_arg(message.text)
+    if not n:
+        await message.answer("Использование: /fitr price 10")
         return
-    n = extract_positive_int(message.text)
     await kv_set("fitr_saa_eur", str(n))
     await message.answer("OK")
 
-@dp.message(F.text.regexp(r"^/fitr\s+list$"))
+def fitr_row_line(row_id, display_name, country, city, amount_eur, code, rice_kg, method, comment="") -> str:
+    place = ", ".join([x for x in [country, city] if x])
+    # Fixed columns (empty ones shown as "-") so rows line up; the comment is the optional tail.
+    cols = [
+        f"{row_id}. {display_name}" + (f" ({place})" if place else ""),
+        f"{amount_eur}€",
+        code or "-",
+        f"{rice_kg} кг",
+        method or "-",
+    ]
+    if comment:
+        cols.append(comment)
+    return " — ".join(cols)
+
+@admin_router.message(F.text.regexp(r"^/fitr\s+list$"))
 async def admin_fitr_list(message: Message):
-    if not admin_only(message.from_user.id):
-        return
     rows = await get_fitr_rows()
     if not rows:
         await message.answer("Список пуст.")
         return
-    lines = []
-    for r in rows:
-        row_id, display_name, country, city, amount_eur, code, rice_kg, method, comment = r
-        place = ", ".join([x for x in [country, city] if x])
-        s = f"{row_id}. {display_name}"
-        if place:
-            s += f" ({place})"
-        s += f" — {amount_eur}€ — {code} — {rice_kg} кг — {method}"
-        if comment:
-            s += f" — {comment}"
-        lines.append(s)
-    await message.answer("\n".join(lines[:80]))
-
-@dp.message(F.text.regexp(r"^/fitr\s+find\s+.+$"))
+    await message.answer("\n".join(fitr_row_line(*r) for r in rows))
+
+@admin_router.message(F.text.regexp(r"^/fitr\s+find\s+.+$"))
 async def admin_fitr_find(message: Message):
-    if not admin_only(message.from_user.id):
-        return
-    term = re.sub(r"^/fitr\s+find\s+", "", message.text.strip(), flags=re.I)
+    term = fitr_subcommand_args(message.text)
     rows = await find_fitr_rows(term)
     if not rows:
         await message.answer("Ничего не найдено.")
         return
-    lines = []
-    for r in rows:
-        row_id, display_name, country, city, amount_eur, code, rice_kg, method = r
-        place = ", ".join([x for x in [country, city] if x])
-        s = f"{row_id}. {display_name}"
-        if place:
-            s += f" ({place})"
-        s += f" — {amount_eur}€ — {code} — {rice_kg} кг — {method}"
-        lines.append(s)
-    await message.answer("\n".join(lines[:50]))
-
-@dp.message(F.text.regexp(r"^/fitr\s+dup$"))
+    await message.answer("\n".join(fitr_row_line(*r) for r in rows))
+
+@admin_router.message(F.text.regexp(r"^/fitr\s+dup$"))
 async def admin_fitr_dup(message: Message):
-    if not admin_only(message.from_user.id):
-        return
     rows = await possible_fitr_dups()
     if not rows:
         await message.answer("Дублей не найдено.")
         return
     lines = [f"{a}. {an} {ac}  <->  {b}. {bn} {bc}" for a, an, ac, b, bn, bc in rows]
-    await message.answer("\n".join(lines[:50]))
+    await message.answer("\n".join(lines))
 
-@dp.message(F.text.regexp(r"^/fitr\s+add\s+.+$"))
+@admin_router.message(F.text.regexp(r"^/fitr\s+add\s+.+$"))
 async def admin_fitr_add(message: Message):
-    if not admin_only(message.from_user.id):
-        return
-    raw = re.sub(r"^/fitr\s+add\s+", "", message.text.strip(), flags=re.I)
+    raw = fitr_subcommand_args(message.text)
     parts = [x.strip() for x in raw.split(";")]
 
     if len(parts) < 2:
@@ -1077,23 +1447,20 @@ async def admin_fitr_add(message: Message):
     country = parts[3] if len(parts) > 3 and parts[3] != "-" else ""
     city = parts[4] if len(parts) > 4 and parts[4] != "-" else ""
     comment = parts[5] if len(parts) > 5 and parts[5] != "-" else ""
-    amount = people * int(await kv_get("fitr_saa_eur") or "10")
+    amount = people * await kv_get_int("fitr_saa_eur", 10)
 
-    row_id = await add_fitr_person(ADMIN_ID, "admin", method, display_name, country, city, people, amount, code, comment)
+    row_id = await add_fitr_person(CFG.admin_id, "admin", method, display_name, country, city, people, amount, code, comment)
     await fitr_report_if_needed()
     await message.answer(f"OK #{row_id}")
 
-@dp.message(F.text.regexp(r"^/fitr\s+edit\s+.+$"))
+@admin_router.message(F.text.regexp(r"^/fitr\s+edit\s+.+$"))
 async def admin_fitr_edit(message: Message):
-    if not admin_only(message.from_user.id):
-        return
-    raw = re.sub(r"^/fitr\s+edit\s+", "", message.text.strip(), flags=re.I)
+    raw = fitr_subcommand_args(message.text)
     parts = [x.strip() for x in raw.split(";")]
 
-    if len(parts) < 3:
+    if len(parts) < 3 or not parts[0].isdecimal():
         await message.answer("Использование: /fitr edit ID;Имя;ZF5;paypal;Страна;Город;коммент")
         return
-
     row_id = int(parts[0])
     display_name = parts[1]
     code = parts[2].upper()
@@ -1106,20 +1473,26 @@ async def admin_fitr_edit(message: Message):
     country = parts[4] if len(parts) > 4 and parts[4] != "-" else ""
     city = parts[5] if len(parts) > 5 and parts[5] != "-" else ""
     comment = parts[6] if len(parts) > 6 and parts[6] != "-" else ""
-    amount = people * int(await kv_get("fitr_saa_eur") or "10")
+    amount = people * await kv_get_int("fitr_saa_eur", 10)
 
     await update_fitr_row(row_id, display_name, country, city, people, amount, method, code, comment)
     await fitr_report_if_needed()
     await message.answer("OK")
 
-@dp.message(F.text.regexp(r"^/fitr\s+del\s+\d+$"))
+@admin_router.message(F.text.regexp(r"^/fitr\s+del\s+\d+$"))
 async def admin_fitr_del(message: Message):
-    if not admin_only(message.from_user.id):
+    row_id = parse_int_arg(message.text)
+    if not row_id:
+        await message.answer("Использование: /fitr del ID")
         return
-    row_id = extract_positive_int(message.text)
     await delete_fitr_row(row_id)
     await message.answer("OK")
 
+# Registered last: stale buttons from old messages or finished flows still get their spinner stopped.
+@dp.callback_query()
+async def unhandled_callback(call: CallbackQuery):
+    ack(call)
+
 
 # =========================
 # Health
@@ -1129,19 +1502,33 @@ async def health_server():
     app = web.Application()
 
     async def health(_request):
-        return web.Response(text="ok")
+        return web.Response(body=b"ok", content_type="text/plain")
 
     app.router.add_get("/", health)
 
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", PORT)
+    site = web.TCPSite(runner, "0.0.0.0", CFG.port)
     await site.start()
 
+# Everything the handlers above listen to; Telegram drops all other update types server-side.
+ALLOWED_UPDATES = ["message", "callback_query", "pre_checkout_query"]
+
 async def main():
     await db_init()
     await health_server()
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    admin_worker = asyncio.create_task(admin_notify_worker())
+    try:
+        await dp.start_polling(bot, allowed_updates=ALLOWED_UPDATES, close_bot_session=False)
+    finally:
+        # Let queued admin notices go out before the session closes.
+        try:
+            await asyncio.wait_for(ADMIN_QUEUE.join(), 10)
+        except asyncio.TimeoutError:
+            logging.error("admin queue not drained on shutdown: %d left", ADMIN_QUEUE.qsize())
+        admin_worker.cancel()
+        await bot.session.close()
+        await DB.close()
 
 if __name__ == "__main__":
     asyncio.run(main())